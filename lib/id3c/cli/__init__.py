@@ -4,22 +4,57 @@ A command-line interface to the Infectious Disease Data Distribution Center.
 import click
 import logging
 import pkg_resources
-from typing import NoReturn
+from importlib import import_module
+from pathlib import Path
+from pkgutil import iter_modules
+from typing import Dict, List, NoReturn, Optional
 
 
 LOG = logging.getLogger(__name__)
 
 
+class LazyGroup(click.Group):
+    """
+    A :class:`click.Group` which defers importing the modules that define its
+    subcommands until those subcommands are needed.
+
+    *lazy_commands* maps subcommand names to the names of the modules which
+    register them (e.g. using ``@cli.command(…)``) when imported.
+    """
+    lazy_commands: Dict[str, str]
+
+    def __init__(self, *args, lazy_commands: Dict[str, str] = {}, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.lazy_commands = dict(lazy_commands)
+
+
+    def list_commands(self, ctx: click.Context) -> List[str]:
+        return sorted({*super().list_commands(ctx), *self.lazy_commands})
+
+
+    def get_command(self, ctx: click.Context, name: str) -> Optional[click.Command]:
+        if name not in self.commands and name in self.lazy_commands:
+            LOG.debug(f"Loading command «{name}» from {self.lazy_commands[name]}")
+            import_module(self.lazy_commands[name])
+
+        return super().get_command(ctx, name)
+
+
+# Each top-level id3c.cli.command module or package registers a command of the
+# same name (with hyphens instead of underscores) using @cli.command(…) or
+# @cli.group(…).  Find them without importing them, which is slow and only
+# necessary for the command actually being run.
+COMMAND_MODULES = {
+    module.name.replace("_", "-"): f"{__name__}.command.{module.name}"
+        for module in iter_modules([str(Path(__file__).parent / "command")])
+}
+
+
 # Base command for all other commands
-@click.group(help = __doc__)
+@click.group(cls = LazyGroup, lazy_commands = COMMAND_MODULES, help = __doc__)
 def cli() -> NoReturn:
     pass
 
-
-# Load all top-level id3c.cli.command packages, giving them an
-# opportunity to register their commands using @cli.command(…).
-from .command import *
-
 # Load all extra commands from extensions.
 for extension in pkg_resources.iter_entry_points("id3c.cli.commands"):
     if extension.dist:
@@ -16,10 +16,11 @@ or updated records.
 import click
 import logging
 from datetime import datetime, timezone
+from more_itertools import chunked
 from psycopg2 import sql
-from typing import Any, Tuple, Optional
+from typing import Any, List, Tuple, Optional
 from id3c.cli.command import with_database_session
-from id3c.db import find_identifier, upsert_sample
+from id3c.db import find_identifier, upsert_sample, upsert_samples
 from id3c.db.session import DatabaseSession
 from id3c.db.datatypes import Json
 from . import etl
@@ -40,6 +41,9 @@ LOG = logging.getLogger(__name__)
 REVISION = 1
 ETL_NAME = "manifest"
 
+# Number of manifest records for which samples are upserted together.
+BATCH_SIZE = 500
+
 
 @etl.command("manifest", help = __doc__)
 @with_database_session
@@ -107,86 +111,139 @@ def etl_manifest(*, db: DatabaseSession):
            for update
         """, (Json([{ "etl": ETL_NAME, "revision": REVISION }]),))
 
-    for manifest_record in manifest:
-        with db.savepoint(f"manifest record {manifest_record.id}"):
-            LOG.info(f"Processing record {manifest_record.id}")
-
-            # When updating an existing row, update the identifiers
-            # only if the record has both the 'sample' and
-            # 'collection' keys.
-            should_update_identifiers = "sample" in manifest_record.document \
-                and "collection" in manifest_record.document
-
-             # Sample collection date
-             # Don't pop this entry off the document. For backwards
-             # compatibility reasons, keep it in the document so that 'date'
-             # also gets written to the 'details' column in warehouse.sample.
-            collected_date = manifest_record.document.get("date", None)
-
-            # Attempt to find barcodes and their related identifiers
-            sample_barcode = manifest_record.document.pop("sample", None)
-            sample_identifier = find_identifier(db, sample_barcode) if sample_barcode else None
-            collection_barcode = manifest_record.document.pop("collection", None)
-            collection_identifier = find_identifier(db, collection_barcode) if collection_barcode else None
-
-            # Skip a record if it has no associated barcodes
-            if not sample_barcode and not collection_barcode:
-                LOG.warning(f"Skipping record «{manifest_record.id}» because it has neither a sample "
-                    "barcode nor a collection barcode")
-                mark_skipped(db, manifest_record.id)
-                continue
-
-            # Skip a record if it has a sample barcode but the barcode doesn't match an identifier
-            if sample_barcode and not sample_identifier:
-                LOG.warning(f"Skipping record «{manifest_record.id}» with unknown sample barcode «{sample_barcode}»")
-                mark_skipped(db, manifest_record.id)
-                continue
-
-            # Skip a record if it has a collection barcode but the barcode doesn't match an identifier
-            if collection_barcode and not collection_identifier:
-                LOG.warning(f"Skipping record «{manifest_record.id}» with unknown collection barcode «{collection_barcode}»")
-                mark_skipped(db, manifest_record.id)
-                continue
-
-             # Skip a record if the collection identifier is from an unexpected set
-            if collection_identifier and collection_identifier.set_name not in expected_identifier_sets["collections"]:
-                LOG.warning(f"Skipping record «{manifest_record.id}» because collection identifier found in set «{collection_identifier.set_name}», not \
-                    {expected_identifier_sets['collections']}")
-                mark_skipped(db, manifest_record.id)
-                continue
-
-            # Validate the sample identifer and assert if a record fails
-            if sample_identifier:
-                if (manifest_record.document.get("sample_type") and
-                    manifest_record.document["sample_type"] == "rdt"):
-                    assert sample_identifier.set_name in expected_identifier_sets["rdt"], \
-                        (f"Sample identifier found in set «{sample_identifier.set_name}»," +
-                        f"not {expected_identifier_sets['rdt']}")
-                else:
-                    assert sample_identifier.set_name in expected_identifier_sets["samples"], \
-                        (f"Sample identifier found in set «{sample_identifier.set_name}», " +
-                        f"not {expected_identifier_sets['samples']}")
-
-
-            # Upsert sample cooperatively with enrollments ETL routine
-            #
-            # The details document was intentionally modified by two pop()s
-            # earlier to remove barcodes that were looked up.
-            # The rationale is that we want just one clear place in the
-            # warehouse for each piece of information.
-            sample, status = upsert_sample(db,
-                update_identifiers          = should_update_identifiers,
-                identifier                  = sample_identifier.uuid if sample_identifier else None,
-                collection_identifier       = collection_identifier.uuid if collection_identifier else None,
-                collection_date             = collected_date,
-                encounter_id                = None,
-                additional_details          = manifest_record.document)
-
-            mark_loaded(db, manifest_record.id,
-                status = status,
-                sample_id = sample.id)
-
-            LOG.info(f"Finished processing manifest record {manifest_record.id}")
+    for batch in chunked(manifest, BATCH_SIZE):
+        pending_ids: List[int] = []
+        pending_samples: List[dict] = []
+
+        # If a record fails, still load the samples for the records before it
+        # in this batch, as if each had been upserted as it was processed, so
+        # that they can be committed (e.g. with --prompt) up to the failure.
+        try:
+            for manifest_record in batch:
+                with db.savepoint(f"manifest record {manifest_record.id}"):
+                    LOG.info(f"Processing record {manifest_record.id}")
+
+                    # When updating an existing row, update the identifiers
+                    # only if the record has both the 'sample' and
+                    # 'collection' keys.
+                    should_update_identifiers = "sample" in manifest_record.document \
+                        and "collection" in manifest_record.document
+
+                     # Sample collection date
+                     # Don't pop this entry off the document. For backwards
+                     # compatibility reasons, keep it in the document so that 'date'
+                     # also gets written to the 'details' column in warehouse.sample.
+                    collected_date = manifest_record.document.get("date", None)
+
+                    # Attempt to find barcodes and their related identifiers
+                    sample_barcode = manifest_record.document.pop("sample", None)
+                    sample_identifier = find_identifier(db, sample_barcode) if sample_barcode else None
+                    collection_barcode = manifest_record.document.pop("collection", None)
+                    collection_identifier = find_identifier(db, collection_barcode) if collection_barcode else None
+
+                    # Skip a record if it has no associated barcodes
+                    if not sample_barcode and not collection_barcode:
+                        LOG.warning(f"Skipping record «{manifest_record.id}» because it has neither a sample "
+                            "barcode nor a collection barcode")
+                        mark_skipped(db, manifest_record.id)
+                        continue
+
+                    # Skip a record if it has a sample barcode but the barcode doesn't match an identifier
+                    if sample_barcode and not sample_identifier:
+                        LOG.warning(f"Skipping record «{manifest_record.id}» with unknown sample barcode «{sample_barcode}»")
+                        mark_skipped(db, manifest_record.id)
+                        continue
+
+                    # Skip a record if it has a collection barcode but the barcode doesn't match an identifier
+                    if collection_barcode and not collection_identifier:
+                        LOG.warning(f"Skipping record «{manifest_record.id}» with unknown collection barcode «{collection_barcode}»")
+                        mark_skipped(db, manifest_record.id)
+                        continue
+
+                     # Skip a record if the collection identifier is from an unexpected set
+                    if collection_identifier and collection_identifier.set_name not in expected_identifier_sets["collections"]:
+                        LOG.warning(f"Skipping record «{manifest_record.id}» because collection identifier found in set «{collection_identifier.set_name}», not \
+                        {expected_identifier_sets['collections']}")
+                        mark_skipped(db, manifest_record.id)
+                        continue
+
+                    # Validate the sample identifer and assert if a record fails
+                    if sample_identifier:
+                        if (manifest_record.document.get("sample_type") and
+                            manifest_record.document["sample_type"] == "rdt"):
+                            assert sample_identifier.set_name in expected_identifier_sets["rdt"], \
+                                (f"Sample identifier found in set «{sample_identifier.set_name}»," +
+                                f"not {expected_identifier_sets['rdt']}")
+                        else:
+                            assert sample_identifier.set_name in expected_identifier_sets["samples"], \
+                                (f"Sample identifier found in set «{sample_identifier.set_name}», " +
+                                f"not {expected_identifier_sets['samples']}")
+
+
+                    # Upsert sample cooperatively with enrollments ETL routine
+                    #
+                    # The details document was intentionally modified by two pop()s
+                    # earlier to remove barcodes that were looked up.
+                    # The rationale is that we want just one clear place in the
+                    # warehouse for each piece of information.
+                    pending_ids.append(manifest_record.id)
+                    pending_samples.append({
+                        "update_identifiers":       should_update_identifiers,
+                        "identifier":               sample_identifier.uuid if sample_identifier else None,
+                        "collection_identifier":    collection_identifier.uuid if collection_identifier else None,
+                        "collection_date":          collected_date,
+                        "encounter_id":             None,
+                        "additional_details":       manifest_record.document,
+                    })
+
+        except Exception:
+            LOG.error(f"Failed to process manifest record {manifest_record.id}")
+            load_samples(db, pending_ids, pending_samples)
+            raise
+
+        load_samples(db, pending_ids, pending_samples)
+
+
+def load_samples(db: DatabaseSession, manifest_ids: List[int], samples: List[dict]) -> None:
+    """
+    Upserts *samples* and marks the corresponding *manifest_ids* as loaded.
+
+    Samples are upserted together, but if that fails they're upserted one at
+    a time instead so that those before the failing record are still loaded
+    and the error is attributed to the failing record.
+    """
+    if not samples:
+        return
+
+    try:
+        with db.savepoint(f"manifest records {manifest_ids[0]}–{manifest_ids[-1]}"):
+            upserted = upsert_samples(db, samples)
+
+            for manifest_id, (sample, status) in zip(manifest_ids, upserted):
+                mark_loaded(db, manifest_id,
+                    status = status,
+                    sample_id = sample.id)
+
+                LOG.info(f"Finished processing manifest record {manifest_id}")
+
+    except Exception as error:
+        LOG.debug(f"Upserting samples for manifest records {manifest_ids[0]}–{manifest_ids[-1]} failed ({error}); upserting them individually")
+
+        for manifest_id, sample in zip(manifest_ids, samples):
+            try:
+                with db.savepoint(f"manifest record {manifest_id}"):
+                    upserted_sample, status = upsert_sample(db, **sample)
+
+                    mark_loaded(db, manifest_id,
+                        status = status,
+                        sample_id = upserted_sample.id)
+
+                    LOG.info(f"Finished processing manifest record {manifest_id}")
+
+            except Exception:
+                LOG.error(f"Failed to upsert sample for manifest record {manifest_id}")
+                raise
+
 
 def mark_loaded(db, manifest_id: int, status: str, sample_id: int) -> None:
     LOG.debug(f"Marking sample manifest record {manifest_id} as loaded")
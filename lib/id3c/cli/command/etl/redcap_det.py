@@ -92,6 +92,18 @@ def command_for_project(name: str,
                       "The default (5,000) is somewhat arbitrary and what will or won't strain the REDCap API depends on both the number of repeating instrument/event instances and the REDCap server itself.",
             default = 5000)
 
+        @click.option("--redcap-api-concurrency",
+            metavar = "<number>",
+            help    = "Maximum number of record batches to fetch from REDCap simultaneously. "
+                      "Higher values may speed up fetching many batches, but also put more strain on the REDCap server, which may rate limit requests.",
+            type    = click.IntRange(min = 1),
+            default = 1)
+
+        @click.option("--refresh-metadata",
+            help    = "Ignore locally cached REDCap project metadata (e.g. instrument names) and fetch it fresh.",
+            is_flag = True,
+            default = False)
+
         @click.option("--log-output/--no-output",
             help        = "Write the output FHIR documents to stdout. You will likely want to redirect this to a file",
             default     = False)
@@ -111,123 +123,128 @@ def command_for_project(name: str,
         @with_database_session
         @wraps(routine)
 
-        def decorated(*args, db: DatabaseSession, log_output: bool, det_limit: int = None, redcap_api_batch_size: int, geocoding_cache: str = None, **kwargs):
+        def decorated(*args, db: DatabaseSession, log_output: bool, det_limit: int = None, redcap_api_batch_size: int, redcap_api_concurrency: int, refresh_metadata: bool, geocoding_cache: str = None, **kwargs):
             LOG.debug(f"Starting the REDCap DET ETL routine {name}, revision {revision}")
 
-            project = Project(redcap_url, project_id)
-
-            if det_limit:
-                LOG.debug(f"Processing up to {det_limit:,} pending DETs")
-                limit = sql.Literal(det_limit)
-            else:
-                LOG.debug(f"Processing all pending DETs")
-                limit = sql.SQL("all")
-
-            redcap_det = db.cursor(f"redcap-det {name}")
-            redcap_det.execute(sql.SQL("""
-                select redcap_det_id as id, document
-                  from receiving.redcap_det
-                 where not processing_log @> %s
-                   and document::jsonb @> %s
-                 order by id
-                 limit {}
-                   for update
-                """).format(limit), (Json([etl_id]), Json(det_contains)))
-
-            # First loop of the DETs to determine how to process each one.
-            # Uses `first_complete_dets` to keep track of which DET to
-            # use to process a unique REDCap record.
-            # Uses `all_dets` to keep track of the status for each DET record
-            # so that they can be processed in order of `redcap_det_id` later.
-            #   --Jover, 21 May 2020
-            first_complete_dets: Dict[str, Any] = {}
-            all_dets: List[Dict[str, str]] = []
-            for det in redcap_det:
-                instrument = det.document['instrument']
-                record_id = det.document['record']
-                # Assume we are loading all DETs
-                # Status will be updated to "skip" if DET does not need to be processed
-                det_record = { "id": det.id, "status": "load" }
-
-                # Only pull REDCap record if
-                # `include_incomplete` flag was not included and
-                # the current instrument is complete
-                if not include_incomplete and not is_complete(instrument, det.document):
-                   det_record.update({
-                       "status": "skip",
-                       "reason": "incomplete/unverified DET"
-                   })
-
-                # Check if this is record has an older DET
-                # Skip latest DET in favor of the first DET
-                # This is done to continue our first-in-first-out
-                # semantics of our receiving tables
-                elif first_complete_dets.get(record_id):
-                    det_record.update({
-                        "status": "skip",
-                        "reason": "repeat REDCap record"
-                    })
-
+            with Project(redcap_url, project_id, refresh_metadata = refresh_metadata) as project:
+                if det_limit:
+                    LOG.debug(f"Processing up to {det_limit:,} pending DETs")
+                    limit = sql.Literal(det_limit)
                 else:
-                    first_complete_dets[record_id] = det
-                    det_record["record_id"] = record_id
-
-                all_dets.append(det_record)
-
-            if not first_complete_dets:
-                LOG.info("No new complete DETs found.")
-            else:
-                # Batch request records from REDCap
-                LOG.info(f"Fetching REDCap project {project_id}")
-                record_ids = list(first_complete_dets.keys())
-
-                LOG.info(f"Fetching {len(record_ids):,} REDCap records from project {project.id}")
-
-                # Convert list of REDCap records to a dict so that
-                # records can be looked up by record id.
-                # Records with repeating instruments or longitudinal
-                # events will have multiple entries in the list.
-                redcap_records: DefaultDict[str, List[dict]] = defaultdict(list)
-
-                batches = list(chunked(record_ids, redcap_api_batch_size))
-
-                for i, batch in enumerate(batches, 1):
-                    LOG.info(f"Fetching REDCap record batch {i:,}/{len(batches):,} of size {len(batch):,}")
-
-                    for record in project.records(ids = batch, raw = raw_coded_values):
+                    LOG.debug(f"Processing all pending DETs")
+                    limit = sql.SQL("all")
+
+                redcap_det = db.cursor(f"redcap-det {name}")
+                redcap_det.execute(sql.SQL("""
+                    select redcap_det_id as id, document
+                      from receiving.redcap_det
+                     where not processing_log @> %s
+                       and document::jsonb @> %s
+                     order by id
+                     limit {}
+                       for update
+                    """).format(limit), (Json([etl_id]), Json(det_contains)))
+
+                # First loop of the DETs to determine how to process each one.
+                # Uses `first_complete_dets` to keep track of which DET to
+                # use to process a unique REDCap record.
+                # Uses `all_dets` to keep track of the status for each DET record
+                # so that they can be processed in order of `redcap_det_id` later.
+                #   --Jover, 21 May 2020
+                first_complete_dets: Dict[str, Any] = {}
+                all_dets: List[Dict[str, str]] = []
+                for det in redcap_det:
+                    instrument = det.document['instrument']
+                    record_id = det.document['record']
+                    # Assume we are loading all DETs
+                    # Status will be updated to "skip" if DET does not need to be processed
+                    det_record = { "id": det.id, "status": "load" }
+
+                    # Only pull REDCap record if
+                    # `include_incomplete` flag was not included and
+                    # the current instrument is complete
+                    if not include_incomplete and not is_complete(instrument, det.document):
+                       det_record.update({
+                           "status": "skip",
+                           "reason": "incomplete/unverified DET"
+                       })
+
+                    # Check if this is record has an older DET
+                    # Skip latest DET in favor of the first DET
+                    # This is done to continue our first-in-first-out
+                    # semantics of our receiving tables
+                    elif first_complete_dets.get(record_id):
+                        det_record.update({
+                            "status": "skip",
+                            "reason": "repeat REDCap record"
+                        })
+
+                    else:
+                        first_complete_dets[record_id] = det
+                        det_record["record_id"] = record_id
+
+                    all_dets.append(det_record)
+
+                if not first_complete_dets:
+                    LOG.info("No new complete DETs found.")
+                else:
+                    # Batch request records from REDCap
+                    LOG.info(f"Fetching REDCap project {project_id}")
+                    record_ids = list(first_complete_dets.keys())
+
+                    LOG.info(f"Fetching {len(record_ids):,} REDCap records from project {project.id}")
+
+                    # Convert list of REDCap records to a dict so that
+                    # records can be looked up by record id.
+                    # Records with repeating instruments or longitudinal
+                    # events will have multiple entries in the list.
+                    redcap_records: DefaultDict[str, List[dict]] = defaultdict(list)
+
+                    if redcap_api_concurrency > 1:
+                        records = project.records_parallel(
+                            chunked(record_ids, redcap_api_batch_size),
+                            max_workers = redcap_api_concurrency,
+                            raw = raw_coded_values)
+                    else:
+                        records = project.records_by_ids(
+                            record_ids,
+                            chunk_size = redcap_api_batch_size,
+                            raw = raw_coded_values)
+
+                    for record in records:
                         redcap_records[record.id].append(record)
 
-            # Process all DETs in order of redcap_det_id
-            with pickled_cache(geocoding_cache) as cache:
-                for det in all_dets:
-                    with db.savepoint(f"redcap_det {det['id']}"):
-                        LOG.info(f"Processing REDCap DET {det['id']}")
+                # Process all DETs in order of redcap_det_id
+                with pickled_cache(geocoding_cache) as cache:
+                    for det in all_dets:
+                        with db.savepoint(f"redcap_det {det['id']}"):
+                            LOG.info(f"Processing REDCap DET {det['id']}")
 
-                        if det["status"] == "skip":
-                            LOG.debug(f"Skipping REDCap DET {det['id']} due to {det['reason']}")
-                            mark_skipped(db, det["id"], etl_id, det["reason"])
-                            continue
+                            if det["status"] == "skip":
+                                LOG.debug(f"Skipping REDCap DET {det['id']} due to {det['reason']}")
+                                mark_skipped(db, det["id"], etl_id, det["reason"])
+                                continue
 
-                        received_det = first_complete_dets.pop(det["record_id"])
-                        redcap_record_instances = redcap_records.get(received_det.document["record"])
+                            received_det = first_complete_dets.pop(det["record_id"])
+                            redcap_record_instances = redcap_records.get(received_det.document["record"])
 
-                        if not redcap_record_instances:
-                            LOG.debug(f"REDCap record is missing or invalid.  Skipping REDCap DET {received_det.id}")
-                            mark_skipped(db, received_det.id, etl_id, "invalid REDCap record")
-                            continue
+                            if not redcap_record_instances:
+                                LOG.debug(f"REDCap record is missing or invalid.  Skipping REDCap DET {received_det.id}")
+                                mark_skipped(db, received_det.id, etl_id, "invalid REDCap record")
+                                continue
 
-                        bundle = routine(db = db, cache = cache, det = received_det, redcap_record_instances = redcap_record_instances)
+                            bundle = routine(db = db, cache = cache, det = received_det, redcap_record_instances = redcap_record_instances)
 
-                        if not bundle:
-                            LOG.debug(f"Skipping REDCap DET {received_det.id} due to insufficient data in REDCap record.")
-                            mark_skipped(db, received_det.id, etl_id, "insufficient data in record")
-                            continue
+                            if not bundle:
+                                LOG.debug(f"Skipping REDCap DET {received_det.id} due to insufficient data in REDCap record.")
+                                mark_skipped(db, received_det.id, etl_id, "insufficient data in record")
+                                continue
 
-                        if log_output:
-                            print(as_json(bundle))
+                            if log_output:
+                                print(as_json(bundle))
 
-                        insert_fhir_bundle(db, bundle)
-                        mark_loaded(db, received_det.id, etl_id, bundle['id'])
+                            insert_fhir_bundle(db, bundle)
+                            mark_loaded(db, received_det.id, etl_id, bundle['id'])
 
         return decorated
     return decorator
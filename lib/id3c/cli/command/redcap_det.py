@@ -14,7 +14,7 @@ scenarios when this happens are:
 import os
 import click
 import logging
-from typing import List
+from typing import List, Sequence
 from id3c.cli import cli
 from id3c.cli.redcap import Project, completion_status_field, is_complete, det
 from id3c.db.session import DatabaseSession
@@ -78,8 +78,20 @@ def redcap_det():
     is_flag = True,
     flag_value = True)
 
+@click.option("--cache/--no-cache",
+    help = "Cache responses from the REDCap API on disk for an hour and reuse them on subsequent runs.  "
+           "Useful when repeatedly generating the same DET notifications.",
+    default = False,
+    envvar = "REDCAP_CACHE",
+    show_envvar = True)
+
+@click.option("--refresh-metadata",
+    help = "Ignore locally cached REDCap project metadata (e.g. instrument names) and fetch it fresh.",
+    is_flag = True,
+    flag_value = True)
+
 def generate(record_ids: List[str], api_url: str, project_id: int, token: str, since_date: str, until_date: str,
-    instruments: List[str], events: List[str], include_incomplete: bool):
+    instruments: Sequence[str], events: List[str], include_incomplete: bool, cache: bool, refresh_metadata: bool):
     """
     Generate DET notifications for REDCap records.
 
@@ -99,58 +111,58 @@ def generate(record_ids: List[str], api_url: str, project_id: int, token: str, s
     """
     api_token = os.environ[token] if token else None
 
-    project = Project(api_url, project_id, token = api_token)
-
-    LOG.info(f"REDCap project #{project.id}: {project.title}")
-
-    if bool(since_date or until_date) and bool(record_ids):
-        raise click.UsageError("The REDCap API does not support fetching records filtered by id *and* date.")
-
-    if since_date and until_date:
-        LOG.debug(f"Getting all records that have been created/modified between {since_date} and {until_date}")
-    elif since_date:
-        LOG.debug(f"Getting all records that have been created/modified since {since_date}")
-    elif until_date:
-        LOG.debug(f"Getting all records that have been created/modified before {until_date}")
-    elif record_ids:
-        LOG.debug(f"Getting specified records: {record_ids}")
-    else:
-        LOG.debug(f"Getting all records")
-
-    if events:
-        LOG.debug(f"Producing DET notifications for the following events: {events}")
-        assert_known_attribute_value(project, 'events', events, 'event')
-    else:
-        LOG.debug(f"Producing DET notifications for all events ({project.events})")
-        events = project.events
-
-    if instruments:
-        LOG.debug(f"Producing DET notifications for the following {'instruments' if include_incomplete else 'complete instruments'}: {instruments}")
-        assert_known_attribute_value(project, 'instruments', instruments, 'instrument')
-    else:
-        LOG.debug(f"Producing DET notifications for all {'instruments' if include_incomplete else 'complete instruments'} ({project.instruments})")
-        instruments = project.instruments
-
-    fields = [
-        project.record_id_field,
-        *map(completion_status_field, instruments),
-    ]
-
-    records = project.records(
-        since_date = since_date,
-        until_date = until_date,
-        ids = record_ids or None,
-        fields = fields,
-        events = events,
-        raw = True)
-
-    for record in records:
-        for instrument in instruments:
-            if include_incomplete or is_complete(instrument, record):
-                print(as_json(det(project, record, instrument)))
-
-
-def assert_known_attribute_value(project: Project, attribute: str, values: List[str], option: str=None):
+    with Project(api_url, project_id, token = api_token, cache = cache, refresh_metadata = refresh_metadata) as project:
+        LOG.info(f"REDCap project #{project.id}: {project.title}")
+
+        if bool(since_date or until_date) and bool(record_ids):
+            raise click.UsageError("The REDCap API does not support fetching records filtered by id *and* date.")
+
+        if since_date and until_date:
+            LOG.debug(f"Getting all records that have been created/modified between {since_date} and {until_date}")
+        elif since_date:
+            LOG.debug(f"Getting all records that have been created/modified since {since_date}")
+        elif until_date:
+            LOG.debug(f"Getting all records that have been created/modified before {until_date}")
+        elif record_ids:
+            LOG.debug(f"Getting specified records: {record_ids}")
+        else:
+            LOG.debug(f"Getting all records")
+
+        if events:
+            LOG.debug(f"Producing DET notifications for the following events: {events}")
+            assert_known_attribute_value(project, 'events', events, 'event')
+        else:
+            LOG.debug(f"Producing DET notifications for all events ({project.events})")
+            events = project.events
+
+        if instruments:
+            LOG.debug(f"Producing DET notifications for the following {'instruments' if include_incomplete else 'complete instruments'}: {instruments}")
+            assert_known_attribute_value(project, 'instruments', instruments, 'instrument')
+        else:
+            LOG.debug(f"Producing DET notifications for all {'instruments' if include_incomplete else 'complete instruments'} ({project.instruments})")
+            instruments = project.instruments
+
+        fields = [
+            project.record_id_field,
+            *map(completion_status_field, instruments),
+        ]
+
+        records = project.records(
+            since_date = since_date,
+            until_date = until_date,
+            ids = record_ids or None,
+            fields = fields,
+            events = events,
+            raw = True,
+            stream = True)
+
+        for record in records:
+            for instrument in instruments:
+                if include_incomplete or is_complete(instrument, record):
+                    print(as_json(det(project, record, instrument)))
+
+
+def assert_known_attribute_value(project: Project, attribute: str, values: Sequence[str], option: str=None):
     """
     Throws an :class:`Exception` if the given REDCap *project* contains no
     values for the given *attribute*.
@@ -1,15 +1,23 @@
 """
 Minimal library for interacting with REDCap's web API.
 """
+import ijson
 import json
 import logging
 import os
-import re
 import requests
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from enum import Enum
 from functools import lru_cache
+from hashlib import blake2b
+from more_itertools import chunked
 from operator import itemgetter
-from typing import Any, Dict, Iterator, List, Optional, Tuple, Union
+from pathlib import Path
+from requests.adapters import HTTPAdapter
+from tempfile import NamedTemporaryFile
+from typing import Any, DefaultDict, Dict, Iterable, Iterator, List, Optional, Tuple, Union
 from .utils import running_command_name
 from ..json import as_json, load_json
 from ..url import Url
@@ -28,15 +36,37 @@ class Project:
     the keyword-only argument, *token*, to explicitly specify an API token to
     use.
 
-    During initialization, project metadata is fetched via the API.  The given
-    *project_id* must match the project id returned in the metadata.  This is a
-    safety check that the API token is for the intended project, since tokens
-    determine the project accessed.
+    During initialization, project details are loaded, either from the
+    metadata cache (see below) or via the API.  The given *project_id* must
+    match the project id in those details.  This is a safety check that the
+    API token is for the intended project, since tokens determine the project
+    accessed.
 
     If the *dry_run* keyword-only argument is set to ``True``, then methods
     which could modify data in REDCap will pretend to succeed but not actually
     make API requests.  Read-only methods are unaffected and will return real
     data.  Defaults to ``False``.
+
+    If the *cache* keyword-only argument is set to ``True``, then responses
+    to read-only API requests are cached on disk for a short time (see
+    :class:`ResponseCache`) and reused by subsequent requests, including
+    those from other processes.  The cache is cleared whenever the project
+    updates records or fields.  This is most useful when repeatedly running
+    the same commands during development or backfills.  Defaults to
+    ``False``.
+
+    Project details and instrument names, which rarely change, are always
+    cached on disk for a day (see :data:`METADATA_CACHE_TTL`) so that
+    constructing a project usually doesn't require any API requests.  If the
+    *refresh_metadata* keyword-only argument is set to ``True``, then cached
+    metadata is ignored and refreshed instead.  Defaults to ``False``.
+
+    API requests are made over a persistent HTTP session so that connections
+    to the REDCap server are reused across requests.  Projects may be used as
+    a context manager to close the session's connections when done::
+
+        with Project(url, project_id) as project:
+            ...
     """
     api_url: str
     api_token: str
@@ -44,12 +74,17 @@ class Project:
     dry_run: bool
     id: int
     _details: dict
-    _instruments: List[str] = None
+    _instruments: Optional[Tuple[str, ...]] = None
     _events: List[str] = None
     _fields: List[dict] = None
     _redcap_version: str = None
+    _session: requests.Session
+    _pool_maxsize: int = 0
+    _cache: Optional['ResponseCache'] = None
+    _metadata_cache: 'ResponseCache'
+    _refresh_metadata: bool
 
-    def __init__(self, url: str, project_id: int, arg3 = None, *, token: str = None, dry_run: bool = False) -> None:
+    def __init__(self, url: str, project_id: int, arg3 = None, *, token: str = None, dry_run: bool = False, cache: bool = False, refresh_metadata: bool = False) -> None:
         # XXX TODO: Remove this and the associated "arg3" once we update all
         # existing callers to use the signature that takes only 2 positional
         # args + token as a keyword-only arg.
@@ -63,6 +98,18 @@ class Project:
         self.dry_run = bool(dry_run)
         self.id = int(project_id)
 
+        # Reuse connections (and thus skip repeated TCP and TLS handshakes)
+        # across the many requests we typically make to the same host.
+        self._session = requests.Session()
+        self._session.headers.update({'Accept': 'application/json'})
+        self._grow_connection_pool(16)
+
+        if cache:
+            self._cache = ResponseCache()
+
+        self._metadata_cache = ResponseCache(cache_directory() / "redcap-meta", ttl = METADATA_CACHE_TTL)
+        self._refresh_metadata = bool(refresh_metadata)
+
         # Check if project details match our expectations
         self._details = self._fetch("project")
 
@@ -77,13 +124,13 @@ class Project:
 
 
     @property
-    def instruments(self) -> List[str]:
+    def instruments(self) -> Tuple[str, ...]:
         """
         Names of all instruments in this REDCap project.
         """
-        if not self._instruments:
+        if self._instruments is None:
             nameof = itemgetter("instrument_name")
-            self._instruments = list(map(nameof, self._fetch("instrument")))
+            self._instruments = tuple(map(nameof, self._fetch("instrument")))
 
         return self._instruments
 
@@ -157,6 +204,65 @@ class Project:
         return self.records(ids = [record_id], raw = raw) # type: ignore
 
 
+    def records_by_ids(self, ids: Iterable[str], *, chunk_size: int = 500, **kwargs) -> Iterator['Record']:
+        """
+        Fetch the REDCap records for all of the given record *ids*.
+
+        Records are fetched in batches of at most *chunk_size* ids per API
+        request, which is far faster than calling :meth:`.record` for each id
+        while keeping each request under REDCap's limits on request size.
+
+        Any additional keyword arguments are passed through to
+        :meth:`.records`, except *page_size* which is not supported.  Records
+        are streamed (see *stream*) unless ``stream = False`` is passed.
+
+        Returns an iterator of records.  As with :meth:`.record`, there may be
+        more than one result per record id.
+        """
+        assert "page_size" not in kwargs, \
+            "The page_size parameter is not supported by records_by_ids()"
+
+        kwargs.setdefault("stream", True)
+
+        for i, chunk in enumerate(chunked(ids, chunk_size), 1):
+            LOG.debug(f"Fetching batch {i:,} of {len(chunk):,} REDCap records for {self}")
+            yield from self.records(ids = chunk, **kwargs)
+
+
+    def records_parallel(self, id_batches: Iterable[List[str]], *, max_workers: int = 8, **kwargs) -> Iterator['Record']:
+        """
+        Fetch the REDCap records for each batch of record ids in *id_batches*
+        concurrently, using up to *max_workers* simultaneous API requests.
+
+        Fetching records is mostly spent waiting on the REDCap server, so
+        concurrent requests can be much faster than sequential ones, up to
+        the point the server itself becomes the bottleneck.  Be considerate of
+        the server when choosing *max_workers*, as REDCap may rate limit API
+        requests.
+
+        Any additional keyword arguments are passed through to
+        :meth:`.records`, except *page_size* and *stream* which are not
+        supported.
+
+        Returns an iterator of records from each batch, with batches in the
+        order their requests complete.
+        """
+        assert "page_size" not in kwargs and "stream" not in kwargs, \
+            "The page_size and stream parameters are not supported by records_parallel()"
+
+        # Avoid "connection pool is full" warnings and discarded connections
+        self._grow_connection_pool(max_workers)
+
+        with ThreadPoolExecutor(max_workers = max_workers) as executor:
+            futures = [
+                executor.submit(self.records, ids = batch, **kwargs)
+                    for batch in id_batches
+            ]
+
+            for future in as_completed(futures):
+                yield from future.result()
+
+
     def records(self, *,
                 since_date: str = None,
                 until_date: str = None,
@@ -166,7 +272,9 @@ class Project:
                 events: List[str] = None,
                 filter: str = None,
                 raw: bool = False,
-                page_size: int = None) -> Union[List['Record'], Iterator['Record']]:
+                page_size: int = None,
+                eav: bool = False,
+                stream: bool = False) -> Union[List['Record'], Iterator['Record']]:
         """
         Fetch records for this REDCap project.
 
@@ -211,9 +319,25 @@ class Project:
         bound in order to catch anything created since the start of the
         pagination process.  When *page_size* is provided, an iterator, as
         opposed to a list, is returned.
+
+        The optional *eav* parameter, when true, requests records from REDCap
+        in its entity-attribute-value format and pivots them into flat records
+        locally.  This avoids making the REDCap server build (and send) the
+        full, mostly empty matrix of every field for every record, which is
+        much faster for large, sparse projects.  The pivoted records differ
+        from the default flat records in that fields without a value are
+        absent instead of present with an empty string and only checked
+        checkbox options are included.
+
+        The optional *stream* parameter, when true, parses records
+        incrementally as the API response is received instead of loading the
+        entire response into memory first.  This greatly reduces peak memory
+        use for large fetches.  When *stream* is true, an iterator, as opposed
+        to a list, is returned and it must be consumed before the response is
+        released.
         """
         parameters = {
-            'type': 'flat',
+            'type': 'eav' if eav else 'flat',
             'rawOrLabel': 'raw' if raw else 'label',
             'exportCheckboxLabel': 'true', # ignored by API if rawOrLabel == raw
             'exportSurveyFields': 'true', # pulls the _identifier and _timestamp fields from surveys
@@ -244,12 +368,14 @@ class Project:
             parameters['filterLogic'] = str(filter)
 
         if page_size is not None:
-            return self._fetch_records_paged(parameters, page_size)
+            return self._fetch_records_paged(parameters, page_size, stream = stream)
+        elif stream:
+            return self._fetch_records(parameters, stream = True)
         else:
             return list(self._fetch_records(parameters))
 
 
-    def _fetch_records_paged(self, parameters: dict, page_size: int) -> Iterator['Record']:
+    def _fetch_records_paged(self, parameters: dict, page_size: int, *, stream: bool = False) -> Iterator['Record']:
         assert bool(self._details["record_autonumbering_enabled"]), \
             "Record auto-numbering must be enabled to use page_size parameter"
 
@@ -279,11 +405,34 @@ class Project:
             else:
                 page_parameters["filterLogic"] = page_filter
 
-            yield from self._fetch_records(page_parameters)
+            yield from self._fetch_records(page_parameters, stream = stream)
+
+
+    def _fetch_records(self, parameters: dict, *, stream: bool = False) -> Iterator['Record']:
+        records = self._fetch("record", parameters, stream = stream)
+
+        if parameters.get("type") == "eav":
+            records = self._pivot_eav(records, raw = parameters.get("rawOrLabel") == "raw")
+
+        return (Record(self, r) for r in records)
 
 
-    def _fetch_records(self, parameters: dict) -> Iterator['Record']:
-        return (Record(self, r) for r in self._fetch("record", parameters))
+    def _pivot_eav(self, rows: Iterable[dict], *, raw: bool) -> List[dict]:
+        """
+        Pivots REDCap EAV export *rows* into flat records using this project's
+        metadata.  See :func:`pivot_eav`.
+        """
+        checkbox_choices = {
+            field["field_name"]: field_choices(field)
+                for field in self.fields
+                 if field["field_type"] == "checkbox"
+        }
+
+        return pivot_eav(
+            rows,
+            record_id_field = self.record_id_field,
+            checkbox_choices = checkbox_choices,
+            raw = raw)
 
 
     def update_records(self, records: List[Dict[str, str]], date_format: str = "YMD", check_count: bool = True) -> int:
@@ -326,6 +475,7 @@ class Project:
         if not self.dry_run:
             LOG.debug(f"Updating {expected_count:,} REDCap records for {self}")
             result = self._fetch("record", parameters)
+            self._invalidate_cache()
 
             updated_count = int(result["count"])
         else:
@@ -389,6 +539,7 @@ class Project:
         if not self.dry_run:
             LOG.debug(f"Updating {expected_count:,} REDCap metadata for {self}")
             result = self._fetch("metadata", parameters)
+            self._invalidate_cache()
 
             updated_count = result
         else:
@@ -400,9 +551,12 @@ class Project:
 
         LOG.debug(f"Updated {updated_count:,} REDCap metadata for {self}")
 
-        # Invalidate fields property cache so it's refreshed with any updates
-        # we just made next time it's needed (if ever).
+        # Invalidate fields and instruments property caches so they're
+        # refreshed with any updates we just made next time they're needed (if
+        # ever).
         self._fields = None
+        self._instruments = None
+        self._metadata_cache.delete(self._metadata_cache.key(self.api_url, self._request_data("instrument")))
 
         return updated_count
 
@@ -460,13 +614,20 @@ class Project:
         return updated_count
 
 
-    def _fetch(self, content: str, parameters: Dict[str, str] = {}, *, format: str = "json") -> Any:
+    def _fetch(self, content: str, parameters: Dict[str, str] = {}, *, format: str = "json", stream: bool = False) -> Any:
         """
         Fetch REDCap *content* with a POST request to the REDCap API.
 
         Consult REDCap API documentation for required and optional parameters
         to include in API request.
+
+        If *stream* is true, the response must be a JSON array and an iterator
+        over its items, which are parsed incrementally as the response is
+        received, is returned.  Streamed responses are never cached.
         """
+        assert not stream or format == "json", \
+            "Only JSON responses may be streamed"
+
         loggable_parameters = parameters.copy()
 
         if "data" in loggable_parameters:
@@ -474,17 +635,30 @@ class Project:
 
         LOG.debug(f"Requesting content={content} from REDCap with params {loggable_parameters} for {self}")
 
-        headers = {
-            'Content-type': 'application/x-www-form-urlencoded',
-            'Accept': 'application/json' if format == "json" else 'text/*'
-        }
+        # The session sends "Accept: application/json" by default.
+        headers = {'Accept': 'text/*'} if format != "json" else None
 
-        data = {
-            **parameters,
-            'content': content,
-            'token': self.api_token,
-            'format': format,
-        }
+        data = self._request_data(content, parameters, format = format)
+
+        cache = self._response_cache(content, parameters) if not stream else None
+
+        if cache:
+            cache_key = cache.key(self.api_url, data)
+
+            if cache is not self._metadata_cache or not self._refresh_metadata:
+                cached_response = cache.get(cache_key)
+
+                if cached_response is not None:
+                    LOG.debug(f"Using cached response for content={content} for {self}")
+
+                    if format != "json":
+                        return cached_response
+
+                    try:
+                        return load_json(cached_response)
+                    except json.JSONDecodeError:
+                        LOG.warning(f"Discarding undecodable cached response for content={content} for {self}")
+                        cache.delete(cache_key)
 
         retry_count = 0
         max_retry_count = 10
@@ -494,7 +668,13 @@ class Project:
         # in many cases succeeds with additional attempts.
         # -drr, 7/28/2021
         while retry_count <= max_retry_count:
-            response = requests.post(self.api_url, data=data, headers=headers)
+            response = self._session.post(self.api_url, data=data, headers=headers, stream=stream)
+
+            # Don't consume a streamed response's body unless it might be the
+            # HTML error page.
+            if stream and 'html' not in response.headers.get('Content-Type', ''):
+                break
+
             if response.status_code==200 and 'multiple browser tabs of the same REDCap page. If that is not the case' in response.text:
                 retry_count += 1
                 LOG.debug(f"Retrying REDCap API request: {retry_count}/{max_retry_count}")
@@ -508,13 +688,108 @@ class Project:
 
         LOG.debug(f"{response.status_code} {response.reason} response for content={content} for {self}")
 
-        return load_json(response.text) if format == "json" else response.text
+        if stream:
+            return stream_json_items(response)
+
+        result = load_json(response.text) if format == "json" else response.text
+
+        # Only cache responses which decoded successfully and aren't an HTML
+        # error page (which REDCap sometimes returns with a 200 status), so a
+        # bad response isn't reused until it expires.
+        if cache and 'html' not in response.headers.get('Content-Type', ''):
+            cache.set(cache_key, response.text)
+
+        return result
+
+
+    def _invalidate_cache(self) -> None:
+        """
+        Discards all cached responses, if caching is enabled, after a request
+        which modified data in REDCap.
+
+        Any cached response may now be stale, and record responses can't be
+        identified by their key, so the whole cache is cleared.  This also
+        keeps other processes sharing the cache from using stale responses.
+        """
+        if self._cache:
+            LOG.debug(f"Clearing cached REDCap responses after modifying {self}")
+            self._cache.clear()
+
+
+    def _grow_connection_pool(self, size: int) -> None:
+        """
+        Ensures the HTTP session's connection pool holds at least *size*
+        connections per host.
+        """
+        if size <= self._pool_maxsize:
+            return
+
+        adapter = HTTPAdapter(pool_connections = 4, pool_maxsize = size)
+        self._session.mount("https://", adapter)
+        self._session.mount("http://", adapter)
+        self._pool_maxsize = size
+
+
+    def _request_data(self, content: str, parameters: Dict[str, str] = {}, *, format: str = "json") -> Dict[str, str]:
+        """
+        Returns the POST data for an API request for *content*.
+        """
+        return {
+            **parameters,
+            'content': content,
+            'token': self.api_token,
+            'format': format,
+        }
+
+
+    def _response_cache(self, content: str, parameters: Dict[str, str]) -> Optional['ResponseCache']:
+        """
+        Returns the cache to use for an API request for *content* with
+        *parameters*, or ``None`` if it shouldn't be cached.
+        """
+        if content in METADATA_CONTENT and not parameters:
+            return self._metadata_cache
+
+        if self._cache and is_cacheable(content, parameters):
+            return self._cache
+
+        return None
+
+
+    def close(self) -> None:
+        """
+        Close the underlying HTTP session and any pooled connections.
+        """
+        self._session.close()
+
+
+    def __enter__(self) -> 'Project':
+        return self
+
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
 
 
     def __repr__(self) -> str:
         return f"<{self.__module__}.{type(self).__name__} object: api_url={self.api_url!r} project_id={self.id!r}>"
 
 
+# Fields which, along with the record id, identify the record instance to
+# which a row in REDCap's EAV export belongs.
+EAV_INSTANCE_FIELDS = (
+    "redcap_event_name",
+    "redcap_repeat_instrument",
+    "redcap_repeat_instance",
+)
+
+
+# Kinds of project metadata which are always cached, and for how long (in
+# seconds).
+METADATA_CONTENT = {"project", "instrument"}
+METADATA_CACHE_TTL = 60 * 60 * 24
+
+
 @lru_cache()
 def CachedProject(api_url: str, project_id: int, *, token: str = None) -> Project:
     """
@@ -526,6 +801,188 @@ def CachedProject(api_url: str, project_id: int, *, token: str = None) -> Projec
     return Project(api_url, project_id, token = token)
 
 
+class ResponseCache:
+    """
+    An on-disk cache of REDCap API responses.
+
+    Each response is stored as a separate file, named by its key, in the
+    directory *path*, which defaults to ``redcap/`` under
+    :func:`cache_directory`.
+
+    Cached responses expire *ttl* seconds (default 1 hour) after they're
+    stored.  At most *max_entries* responses are kept; when more are stored,
+    the least recently used are evicted.
+
+    >>> from tempfile import TemporaryDirectory
+    >>> with TemporaryDirectory() as tmpdir:
+    ...     cache = ResponseCache(tmpdir, max_entries = 2)
+    ...     a, b, c = (cache.key("https://example.com/api/", {"n": n}) for n in range(3))
+    ...     cache.set(a, "A")
+    ...     cache.set(b, "B")
+    ...     cache.get(a)
+    ...     cache.set(c, "C")
+    ...     [cache.get(a), cache.get(b), cache.get(c)]
+    ...     cache.clear()
+    ...     [cache.get(a), cache.get(b), cache.get(c)]
+    'A'
+    ['A', None, 'C']
+    [None, None, None]
+    """
+    path: Path
+    ttl: int
+    max_entries: int
+
+    def __init__(self, path: Union[str, Path] = None, *, ttl: int = 60 * 60, max_entries: int = 256) -> None:
+        if path is None:
+            path = cache_directory() / "redcap"
+
+        self.path = Path(path)
+        self.ttl = ttl
+        self.max_entries = max_entries
+
+
+    def key(self, api_url: str, data: Dict[str, str]) -> str:
+        """
+        Returns the cache key for a request to *api_url* with *data*.
+
+        *data* includes the API token, so only a hash of it is used.
+        """
+        return blake2b(json.dumps([api_url, data], sort_keys = True).encode("utf-8")).hexdigest()
+
+
+    def get(self, key: str) -> Optional[str]:
+        """
+        Returns the cached response for *key*, or ``None`` if there's no
+        unexpired response.
+        """
+        file = self.path / key
+
+        try:
+            with file.open(encoding = "utf-8") as f:
+                entry = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+
+        if time.time() - entry["stored"] > self.ttl:
+            LOG.debug(f"Expiring cached REDCap response {key}")
+            self.delete(key)
+            return None
+
+        # Record the use for LRU eviction.  Explicit times are used because
+        # the filesystem's own timestamps may be too coarse to order entries.
+        now = time.time()
+
+        try:
+            os.utime(str(file), (now, now))
+        except OSError:
+            pass
+
+        return entry["response"]
+
+
+    def delete(self, key: str) -> None:
+        """
+        Removes the cached response for *key*, if any.
+        """
+        try:
+            (self.path / key).unlink()
+        except FileNotFoundError:
+            pass
+
+
+    def clear(self) -> None:
+        """
+        Removes all cached responses.
+        """
+        try:
+            files = list(self.path.iterdir())
+        except FileNotFoundError:
+            return
+
+        for file in files:
+            if not file.name.startswith("."):
+                self.delete(file.name)
+
+
+    def set(self, key: str, response: str) -> None:
+        """
+        Stores *response* under *key*, evicting the least recently used
+        responses if necessary.
+
+        Failures to write to the cache are logged but otherwise ignored.
+        """
+        try:
+            self.path.mkdir(parents = True, exist_ok = True)
+
+            # Write to a temporary file and rename it into place so that
+            # concurrent readers never see a partially-written file.
+            now = time.time()
+
+            with NamedTemporaryFile("w", encoding = "utf-8", dir = str(self.path), prefix = ".", delete = False) as tmp:
+                json.dump({"stored": now, "response": response}, tmp)
+
+            os.utime(tmp.name, (now, now))
+            os.replace(tmp.name, str(self.path / key))
+
+            entries = sorted(
+                (f for f in self.path.iterdir() if not f.name.startswith(".")),
+                key = lambda f: f.stat().st_mtime)
+
+            for file in entries[:-self.max_entries]:
+                LOG.debug(f"Evicting cached REDCap response {file.name}")
+                self.delete(file.name)
+
+        except OSError as error:
+            LOG.warning(f"Unable to cache REDCap response in «{self.path}»: {error}")
+
+
+def cache_directory() -> Path:
+    """
+    Returns the directory under which REDCap API responses are cached.
+
+    This is ``id3c/`` under ``$XDG_CACHE_HOME``, if set, or ``~/.cache``.
+    """
+    return Path(os.environ.get("XDG_CACHE_HOME") or Path.home() / ".cache") / "id3c"
+
+
+def stream_json_items(response: requests.Response) -> Iterator[Any]:
+    """
+    Incrementally parses the items of the JSON array in the body of the
+    streamed *response*, closing the response when done.
+    """
+    with response:
+        response.raw.decode_content = True
+        yield from ijson.items(response.raw, "item", use_float = True)
+
+
+def is_cacheable(content: str, parameters: Dict[str, str]) -> bool:
+    """
+    Test if a REDCap API request for *content* with *parameters* is safe to
+    serve from a :class:`ResponseCache`.
+
+    Requests which modify data are never cacheable, nor are unbounded record
+    exports (i.e. without specific record ids or a date range).
+
+    >>> is_cacheable("metadata", {})
+    True
+    >>> is_cacheable("metadata", {"data": "[]"})
+    False
+    >>> is_cacheable("record", {"type": "flat"})
+    False
+    >>> is_cacheable("record", {"type": "flat", "records": "1,2,3"})
+    True
+    >>> is_cacheable("generateNextRecordName", {})
+    False
+    """
+    if "data" in parameters:
+        return False
+
+    if content == "record":
+        return "records" in parameters or "dateRangeBegin" in parameters
+
+    return content in {"project", "instrument", "event", "metadata", "version"}
+
+
 class Record(dict):
     """
     A single REDCap record ``dict``.
@@ -585,6 +1042,15 @@ class InstrumentStatus(Enum):
     Complete = 2
 
 
+# All the ways REDCap may represent a complete instrument status, depending on
+# the source of the data and if raw or label values were requested.
+COMPLETE_VALUES = frozenset({
+    InstrumentStatus.Complete.name,
+    InstrumentStatus.Complete.value,
+    str(InstrumentStatus.Complete.value),
+})
+
+
 def is_complete(instrument: str, data: dict) -> bool:
     """
     Test if the named *instrument* is marked complete in the given *data*.
@@ -610,11 +1076,7 @@ def is_complete(instrument: str, data: dict) -> bool:
     if instrument_complete_field is None:
         return None
 
-    return instrument_complete_field in {
-        InstrumentStatus.Complete.name,
-        InstrumentStatus.Complete.value,
-        str(InstrumentStatus.Complete.value)
-    }
+    return instrument_complete_field in COMPLETE_VALUES
 
 
 def completion_status_field(instrument: str) -> str:
@@ -639,6 +1101,110 @@ def completion_status_field(instrument: str) -> str:
     return f"{instrument}_complete"
 
 
+def field_choices(field: dict) -> Dict[str, str]:
+    """
+    Returns a dictionary mapping option codes to labels for the given
+    multiple choice *field* from REDCap's project metadata.
+
+    >>> field_choices({"select_choices_or_calculations": "1, Yes | 0, No"})
+    {'1': 'Yes', '0': 'No'}
+    >>> field_choices({"select_choices_or_calculations": "a, Option A, with commas|b, Option B"})
+    {'a': 'Option A, with commas', 'b': 'Option B'}
+    >>> field_choices({"select_choices_or_calculations": ""})
+    {}
+    """
+    choices = {}
+
+    for choice in field["select_choices_or_calculations"].split("|"):
+        if not choice.strip():
+            continue
+
+        code, _, label = choice.partition(",")
+        choices[code.strip()] = label.strip()
+
+    return choices
+
+
+def pivot_eav(rows: Iterable[dict], *, record_id_field: str, checkbox_choices: Dict[str, Dict[str, str]], raw: bool) -> List[dict]:
+    """
+    Pivots REDCap EAV export *rows* into flat records.
+
+    Each EAV row holds the value of a single field for a single record,
+    event, and repeat instance.  Rows are grouped by the latter and their
+    values collected under their field names, with the record id under
+    *record_id_field*.
+
+    Checkbox fields, given by *checkbox_choices* as a mapping of field names
+    to option codes and labels (see :func:`field_choices`), are expanded into
+    per-option fields (``<field>___<code>``) like REDCap's flat export.  Their
+    values are ``1`` if *raw* is true and the option label otherwise.
+
+    >>> rows = [
+    ...     {"record": "1", "field_name": "name", "value": "Ann"},
+    ...     {"record": "1", "field_name": "symptoms", "value": "2"},
+    ...     {"record": "1", "field_name": "symptoms", "value": "Fever"},
+    ...     {"record": "2", "field_name": "name", "value": "Bob"},
+    ... ]
+    >>> choices = {"symptoms": {"1": "Fever", "2": "Cough"}}
+
+    >>> pivot_eav(rows, record_id_field = "record_id", checkbox_choices = choices, raw = True)
+    [{'record_id': '1', 'name': 'Ann', 'symptoms___2': '1', 'symptoms___1': '1'}, {'record_id': '2', 'name': 'Bob'}]
+
+    >>> pivot_eav(rows, record_id_field = "record_id", checkbox_choices = choices, raw = False)
+    [{'record_id': '1', 'name': 'Ann', 'symptoms___2': 'Cough', 'symptoms___1': 'Fever'}, {'record_id': '2', 'name': 'Bob'}]
+
+    Rows for different events or repeat instances of the same record are
+    pivoted into separate records.
+
+    >>> pivot_eav([
+    ...     {"record": "1", "redcap_repeat_instrument": "visit", "redcap_repeat_instance": "1", "field_name": "name", "value": "Ann"},
+    ...     {"record": "1", "redcap_repeat_instrument": "visit", "redcap_repeat_instance": "2", "field_name": "name", "value": "Ann"},
+    ... ], record_id_field = "record_id", checkbox_choices = {}, raw = True)
+    [{'record_id': '1', 'redcap_repeat_instrument': 'visit', 'redcap_repeat_instance': '1', 'name': 'Ann'}, {'record_id': '1', 'redcap_repeat_instrument': 'visit', 'redcap_repeat_instance': '2', 'name': 'Ann'}]
+
+    Raises a :py:exc:`ValueError` if a checkbox value isn't one of the
+    field's known option codes or labels, e.g. because the metadata is out of
+    date.
+
+    >>> pivot_eav([{"record": "1", "field_name": "symptoms", "value": "Rash"}],
+    ...     record_id_field = "record_id", checkbox_choices = choices, raw = True)
+    Traceback (most recent call last):
+        ...
+    ValueError: Unknown option 'Rash' for checkbox field 'symptoms' of record '1'; known options are {'1': 'Fever', '2': 'Cough'}
+    """
+    records: DefaultDict[Tuple, dict] = defaultdict(dict)
+
+    for row in rows:
+        key = tuple(row.get(k) for k in ("record", *EAV_INSTANCE_FIELDS))
+        record = records[key]
+
+        if not record:
+            record[record_id_field] = row["record"]
+
+            for instance_field in EAV_INSTANCE_FIELDS:
+                if instance_field in row:
+                    record[instance_field] = row[instance_field]
+
+        field_name, value = row["field_name"], row["value"]
+
+        if field_name in checkbox_choices:
+            choices = checkbox_choices[field_name]
+
+            if value in choices:
+                code = value
+            else:
+                code = next((c for c, label in choices.items() if label == value), None)
+
+                if code is None:
+                    raise ValueError(f"Unknown option {value!r} for checkbox field {field_name!r} of record {row['record']!r}; known options are {choices!r}")
+
+            record[f"{field_name}___{code.lower()}"] = "1" if raw else choices[code]
+        else:
+            record[field_name] = value
+
+    return list(records.values())
+
+
 def api_token(url: str, project_id: int) -> str:
     """
     Obtain an API token from the environment for the given REDCap *url* and
@@ -737,7 +1303,7 @@ def url_endpoints(url) -> Tuple[str, str]:
     """
     url = Url(url)
 
-    if re.search(r'(?<=/)api/?$', url.path):
+    if url.path.endswith(("/api", "/api/")):
         api_url  = str(url)
         base_url = str(url.parent)
     else:
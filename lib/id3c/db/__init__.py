@@ -2,20 +2,38 @@
 Database interfaces
 """
 import logging
+import os
+import random
 import secrets
 import statistics
-from datetime import datetime
+import time
+from collections import Counter, defaultdict
+from datetime import timedelta
 from psycopg2 import IntegrityError
 from psycopg2.errors import ExclusionViolation
+from psycopg2.extras import execute_values
 from psycopg2.sql import SQL, Identifier, Literal
 from statistics import median, StatisticsError
-from typing import Any, Dict, Iterable, List, Tuple, NamedTuple, Optional
+from typing import Any, DefaultDict, Dict, Iterable, List, Tuple, NamedTuple, Optional
 from .types import IdentifierRecord
 from .session import DatabaseSession
 from .datatypes import Json
 
 LOG = logging.getLogger(__name__)
 
+# Maximum number of identifiers to mint with a single insert statement
+MINT_BATCH_SIZE = 100
+
+# Default maximum number of excluded barcodes to tolerate when minting each
+# identifier.  Failures which only shrink the batch size don't count towards
+# this, but single identifier failures do whether or not they're backed off.
+# Overridden by the ID3C_MINT_MAX_FAILURES environment variable.
+MINT_MAX_FAILURES = 10
+
+# Number of times to try upserting a sample while another transaction holds a
+# lock on the matching sample before waiting for the lock instead.
+UPSERT_SAMPLE_MAX_ATTEMPTS = 5
+
 
 class IdentifierMintingError(Exception):
     pass
@@ -39,9 +57,33 @@ def mint_identifiers(session: DatabaseSession, name: str, n: int) -> Any:
     Raises a :class:`~werkzeug.exceptions.NotFound` exception if the set *name*
     doesn't exist and a :class:`Forbidden` exception if the database reports a
     `permission denied` error.
+
+    Identifiers are minted in batches of up to :data:`MINT_BATCH_SIZE` per
+    insert statement.  A barcode excluded by the minimum distance check fails
+    its whole batch, so failed batches are retried with successively smaller
+    batch sizes (down to a single identifier).  After each success the batch
+    size grows by only one identifier, so it stays near the largest size that
+    recently succeeded instead of repeatedly retrying large batches that are
+    likely to fail in a densely populated barcode space.
+
+    Once the batch size is down to a single identifier, retries after
+    excluded barcodes are delayed by an exponentially increasing, randomly
+    jittered backoff to avoid concurrent minters repeatedly contending with
+    each other.  This only happens before any identifiers are minted.  The
+    barcode exclusion trigger locks ``warehouse.identifier`` until the
+    transaction ends, so afterwards waiting would only block other minters
+    and an excluded barcode can only clash with an existing one; retries are
+    immediate then.  Raises an :class:`IdentifierMintingError` if more than
+    :data:`MINT_MAX_FAILURES` (or the value of the ``ID3C_MINT_MAX_FAILURES``
+    environment variable) single identifier retries are needed for any one
+    identifier.
     """
+    max_failures = int(os.environ.get("ID3C_MINT_MAX_FAILURES") or MINT_MAX_FAILURES)
+
     minted: List[Any] = []
-    failures: Dict[int, int] = {}
+    failures: Counter = Counter()
+    batch_size = MINT_BATCH_SIZE
+    tries = 0
 
     # Lookup identifier set by name
     identifier_set = session.fetch_row("""
@@ -54,36 +96,68 @@ def mint_identifiers(session: DatabaseSession, name: str, n: int) -> Any:
         LOG.error(f"Identifier set «{name}» does not exist")
         raise IdentifierSetNotFoundError(name)
 
-    started = datetime.now()
+    # Prepare the insert once up front so the database doesn't need to parse
+    # and plan it again for every batch.
+    with session.cursor() as cursor:
+        cursor.execute("""
+            prepare mint_identifiers (integer, integer) as
+                insert into warehouse.identifier (identifier_set_id, generated)
+                    select $1, now()
+                      from generate_series(1, $2)
+                    returning uuid, barcode, generated
+            """)
+
+    started = time.monotonic()
+
+    try:
+        while len(minted) < n:
+            m = len(minted) + 1
+            count = min(batch_size, n - len(minted))
+            tries += 1
+
+            LOG.debug(f"Minting identifiers {m}–{m + count - 1}/{n}")
+
+            try:
+                with session.savepoint(f"identifier {m}"):
+                    new_identifiers = session.fetch_all(
+                        "execute mint_identifiers (%s, %s)",
+                        (identifier_set.id, count))
+
+                    minted.extend(new_identifiers)
 
-    while len(minted) < n:
-        m = len(minted) + 1
+            except ExclusionViolation:
+                if count > 1:
+                    # Some barcode in the batch was excluded; retry
+                    # immediately with a smaller batch.
+                    LOG.debug("Barcode excluded. Retrying with a smaller batch.")
+                    batch_size = count // 2
+                    continue
 
-        LOG.debug(f"Minting identifier {m}/{n}")
+                LOG.debug("Barcode excluded. Retrying.")
+                failures[m] += 1
 
-        try:
-            with session.savepoint(f"identifier {m}"):
-                new_identifier = session.fetch_row("""
-                    insert into warehouse.identifier (identifier_set_id, generated)
-                        values (%s, now())
-                        returning uuid, barcode, generated
-                    """,
-                    (identifier_set.id,))
+                if failures[m] > max_failures:
+                    raise IdentifierMintingError(f"Too many excluded barcodes ({failures[m]}) minting identifier {m}/{n}") from None
 
-                minted.append(new_identifier)
+                # Exponential backoff with full jitter, but only while we
+                # don't yet hold the trigger's exclusive table lock.
+                if not minted:
+                    time.sleep(min(0.2 * 2 ** failures[m], 2.0) * random.random())
 
-        except ExclusionViolation:
-            LOG.debug("Barcode excluded. Retrying.")
-            failures.setdefault(m, 0)
-            failures[m] += 1
+            else:
+                batch_size = min(count + 1, MINT_BATCH_SIZE)
 
-    duration = datetime.now() - started
-    per_second = n / duration.total_seconds()
-    per_identifier = duration.total_seconds() / n
+    finally:
+        with session.cursor() as cursor:
+            cursor.execute("deallocate mint_identifiers")
+
+    duration = time.monotonic() - started
+    per_second = n / duration
+    per_identifier = duration / n
 
     failure_counts = list(failures.values())
 
-    LOG.info(f"Minted {n} identifiers in {n + sum(failure_counts)} tries ({sum(failure_counts)} retries) over {duration} ({per_identifier:.2f} s/identifier = {per_second:.2f} identifiers/s)")
+    LOG.info(f"Minted {n} identifiers in {tries} tries ({sum(failure_counts)} retries) over {timedelta(seconds = duration)} ({per_identifier:.2f} s/identifier = {per_second:.2f} identifiers/s)")
 
     if failure_counts:
         LOG.info(f"Failure distribution: max={max(failure_counts)} mode={mode(failure_counts)} median={median(failure_counts)}")
@@ -136,18 +210,22 @@ def grant_roles(session: DatabaseSession, username, roles: Iterable = []) -> Non
     """
     Grants the given set of *roles* to *username*.
     """
+    roles = list(roles)
+
     if not roles:
         LOG.warning("No roles provided; none will be granted.")
         return
 
-    with session.cursor() as cursor:
-        for role in roles:
-            LOG.info(f"Granting «{role}» to «{username}»")
+    for role in roles:
+        LOG.info(f"Granting «{role}» to «{username}»")
 
-            cursor.execute(
-                sqlf("grant {} to {}",
-                     Identifier(role),
-                     Identifier(username)))
+    # A single statement grants all roles at once, saving a round-trip per
+    # role.
+    with session.cursor() as cursor:
+        cursor.execute(
+            sqlf("grant {} to {}",
+                 SQL(", ").join(map(Identifier, roles)),
+                 Identifier(username)))
 
 
 def reset_password(session: DatabaseSession, username) -> str:
@@ -207,6 +285,10 @@ def upsert_sample(db: DatabaseSession,
     *collection_date* updated, and the provided *additional_details* are
     merged (at the top-level only) into the existing sample details, if any.
     Raises an exception if there is more than one matching sample.
+
+    An existing sample locked by another transaction (e.g. a concurrent ETL)
+    is retried after a short, jittered backoff instead of waiting on the lock.
+    Only after :data:`UPSERT_SAMPLE_MAX_ATTEMPTS` tries is the lock waited on.
     """
     data = {
         "identifier": identifier,
@@ -216,63 +298,104 @@ def upsert_sample(db: DatabaseSession,
         "additional_details": Json(additional_details),
     }
 
-    # Look for existing sample(s)
-    with db.cursor() as cursor:
-        cursor.execute("""
-            select sample_id as id, identifier, collection_identifier, encounter_id
+    # Update identifier and collection_identifier if update_identifiers is True
+    identifiers_update_composable = SQL("""
+        identifier = %(identifier)s,
+                   collection_identifier = %(collection_identifier)s, """)  \
+                    if update_identifiers else SQL("")
+
+    # Look for existing sample(s) and then, in the same statement, update the
+    # one found or create one if none were found.  If more than one is found,
+    # they're returned without a status instead.
+    #
+    # Existing samples are found without locking them, so that a sample
+    # locked by another transaction can't hide from the check for more than
+    # one match.  A single match is then locked, skipping it if another
+    # transaction holds a lock on it, in which case nothing is updated or
+    # created and no rows are returned.  The whole statement is retried in
+    # that case.
+    upsert = SQL("""
+        with matching as (
+            select sample_id, identifier, collection_identifier, encounter_id
               from warehouse.sample
              where identifier = %(identifier)s
                 or collection_identifier = %(collection_identifier)s
-               for update
-            """, data)
+             limit 2
+        ),
 
-        samples = list(cursor)
+        existing as (
+            select sample_id
+              from warehouse.sample
+             where sample_id in (select sample_id from matching)
+               and (identifier = %(identifier)s or collection_identifier = %(collection_identifier)s)
+               and (select count(*) from matching) = 1
+               for no key update {skip_locked}
+        ),
 
-    # Nothing found → create
-    if not samples:
-        LOG.info("Creating new sample")
-        status = 'created'
-        
-        sample = db.fetch_row("""
+        updated as (
+            update warehouse.sample
+               set {identifiers_update}
+                   collected = coalesce(date_or_null(%(collection_date)s), collected),
+                   encounter_id = coalesce(%(encounter_id)s, encounter_id),
+                   details = coalesce(details, {empty_details}) || %(additional_details)s
+             where sample_id in (select sample_id from existing)
+            returning sample_id as id, identifier, collection_identifier, encounter_id, 'updated'::text as status
+        ),
+
+        created as (
             insert into warehouse.sample (identifier, collection_identifier, collected, encounter_id, details)
-                values (%(identifier)s,
-                        %(collection_identifier)s,
-                        date_or_null(%(collection_date)s),
-                        %(encounter_id)s,
-                        %(additional_details)s)
-            returning sample_id as id, identifier, collection_identifier, encounter_id
-            """, data)
-
-    # One found → update
-    elif len(samples) == 1:
-        status = 'updated'
-        sample = samples[0]
-
-        LOG.info(f"Updating existing sample {sample.id}")
+                select %(identifier)s,
+                       %(collection_identifier)s,
+                       date_or_null(%(collection_date)s),
+                       %(encounter_id)s,
+                       %(additional_details)s
+                 where not exists (select from matching)
+            on conflict do nothing
+            returning sample_id as id, identifier, collection_identifier, encounter_id, 'created'::text as status
+        )
+
+        select * from updated
+        union all
+        select * from created
+        union all
+        select sample_id as id, identifier, collection_identifier, encounter_id, null as status
+          from matching
+         where (select count(*) from matching) > 1
+        """)
+
+    for attempt in range(1, UPSERT_SAMPLE_MAX_ATTEMPTS + 1):
+        skip_locked = attempt < UPSERT_SAMPLE_MAX_ATTEMPTS
+
+        samples = db.fetch_all(
+            upsert.format(
+                skip_locked = SQL("skip locked") if skip_locked else SQL(""),
+                identifiers_update = identifiers_update_composable,
+                empty_details = Literal(Json({}))),
+            data)
+
+        if samples or not skip_locked:
+            break
+
+        LOG.debug(f"Matching sample is locked by another transaction; retrying ({attempt}/{UPSERT_SAMPLE_MAX_ATTEMPTS})")
+
+        # Exponential backoff with full jitter
+        time.sleep(min(0.05 * 2 ** attempt, 1.0) * random.random())
+
+    # Nothing found, but conflicted with a sample created concurrently → error
+    if not samples:
+        raise Exception("Sample matching sample and/or collection barcodes was concurrently created by another transaction")
 
-        # Update identifier and collection_identifier if update_identifiers is True
-        identifiers_update_composable = SQL("""
-             identifier = %(identifier)s,
-                collection_identifier = %(collection_identifier)s, """)  \
-                    if update_identifiers else SQL("")
+    # More than one found → error
+    if len(samples) != 1:
+        raise Exception(f"More than one sample matching sample and/or collection barcodes: {samples}")
 
-        sample = db.fetch_row(SQL("""
-            update warehouse.sample
-                set {}
-                    collected = coalesce(date_or_null(%(collection_date)s), collected),
-                    encounter_id = coalesce(%(encounter_id)s, encounter_id),
-                    details = coalesce(details, {}) || %(additional_details)s
-             where sample_id = %(sample_id)s
-            returning sample_id as id, identifier, collection_identifier, encounter_id
-            """).format(identifiers_update_composable,
-                Literal(Json({}))),
-                { **data, "sample_id": sample.id })
-
-        assert sample.id, "Update affected no rows!"
+    sample = samples[0]
+    status = sample.status
 
-    # More than one found → error
+    if status == 'created':
+        LOG.info(f"Created new sample {sample.id}")
     else:
-        raise Exception(f"More than one sample matching sample and/or collection barcodes: {samples}")
+        LOG.info(f"Updated existing sample {sample.id}")
 
     if sample:
         if identifier:
@@ -281,3 +404,165 @@ def upsert_sample(db: DatabaseSession,
             LOG.info(f"Upserted sample {sample.id} with collection identifier «{sample.collection_identifier}»")
 
     return sample, status
+
+
+def upsert_samples(db: DatabaseSession, samples: List[dict]) -> List[Tuple[Any, str]]:
+    """
+    Upsert many *samples* at once, as if by calling :func:`upsert_sample` for
+    each in turn.
+
+    Each sample must be a dictionary of the keyword arguments accepted by
+    :func:`upsert_sample`.  Returns a list of ``(sample, status)`` tuples in
+    the same order as *samples*, with the same sample columns (including
+    ``status``) as :func:`upsert_sample` returns.
+
+    Existing samples are looked up, created, and updated for the whole batch
+    using a few statements instead of two per sample.  If samples in the batch
+    share an identifier or collection identifier or match the same existing
+    sample, then their order matters and each sample is upserted in turn
+    instead.  The same is done if any sample has neither identifier, or if
+    any existing sample is locked by another transaction, so it's retried like
+    :func:`upsert_sample` does.
+
+    Raises an exception if there is more than one existing sample matching
+    any of the *samples*.
+    """
+    if not samples:
+        return []
+
+    identifiers = [
+        value
+            for sample in samples
+            for value in (sample["identifier"], sample["collection_identifier"])
+             if value is not None
+    ]
+
+    if len(identifiers) != len(set(identifiers)):
+        LOG.debug("Samples share identifiers; upserting them individually")
+        return [upsert_sample(db, **sample) for sample in samples]
+
+    # New samples are matched back to their input rows by their identifiers
+    # below, which isn't possible without either.
+    if any(sample["identifier"] is None and sample["collection_identifier"] is None for sample in samples):
+        LOG.debug("Samples lack both identifiers; upserting them individually")
+        return [upsert_sample(db, **sample) for sample in samples]
+
+    rows = [
+        { **sample, "ordinal": ordinal, "additional_details": Json(sample["additional_details"]) }
+            for ordinal, sample in enumerate(samples)
+    ]
+
+    def find_existing(locking: SQL) -> List[Any]:
+        with db.cursor() as cursor:
+            return execute_values(cursor, SQL("""
+                select input.ordinal, sample.sample_id as id
+                  from (values %s) as input (ordinal, identifier, collection_identifier)
+                  join warehouse.sample
+                    on sample.identifier = input.identifier
+                    or sample.collection_identifier = input.collection_identifier
+                {}
+                """).format(locking),
+                rows,
+                template = "(%(ordinal)s, %(identifier)s::text, %(collection_identifier)s::text)",
+                page_size = len(rows),
+                fetch = True)
+
+    # Look for existing sample(s) without locking them, so that samples
+    # locked by another transaction can't hide from the checks below.
+    matches = find_existing(SQL(""))
+
+    matched: DefaultDict[int, List[int]] = defaultdict(list)
+
+    for match in matches:
+        matched[match.ordinal].append(match.id)
+
+    # More than one found → error
+    for ordinal, sample_ids in matched.items():
+        if len(sample_ids) > 1:
+            raise Exception(f"More than one sample matching sample and/or collection barcodes: {sample_ids} for {samples[ordinal]}")
+
+    if len(matches) != len({ sample_id for sample_ids in matched.values() for sample_id in sample_ids }):
+        LOG.debug("Samples match the same existing sample; upserting them individually")
+        return [upsert_sample(db, **sample) for sample in samples]
+
+    # Lock the existing samples, as upsert_sample() does, without waiting on
+    # those locked by another transaction (e.g. a concurrent ETL).  If any
+    # are, upsert_sample() retries them individually before waiting.
+    if matches:
+        locked = find_existing(SQL("for no key update of sample skip locked"))
+
+        if set(locked) != set(matches):
+            LOG.debug("Existing samples are locked by another transaction; upserting them individually")
+            return [upsert_sample(db, **sample) for sample in samples]
+
+    results: Dict[int, Tuple[Any, str]] = {}
+
+    # Nothing found → create
+    to_create = [row for row in rows if row["ordinal"] not in matched]
+
+    if to_create:
+        LOG.info(f"Creating {len(to_create):,} new samples")
+
+        with db.cursor() as cursor:
+            created = execute_values(cursor, """
+                insert into warehouse.sample (identifier, collection_identifier, collected, encounter_id, details)
+                    values %s
+                returning sample_id as id, identifier, collection_identifier, encounter_id, 'created'::text as status
+                """,
+                to_create,
+                template = """(
+                    %(identifier)s,
+                    %(collection_identifier)s,
+                    date_or_null(%(collection_date)s),
+                    %(encounter_id)s,
+                    %(additional_details)s)""",
+                page_size = len(to_create),
+                fetch = True)
+
+        # Identifiers are unique within the batch, so they identify which
+        # input row each new sample was created from.
+        ordinals = { (row["identifier"], row["collection_identifier"]): row["ordinal"] for row in to_create }
+
+        for sample in created:
+            results[ordinals[(sample.identifier, sample.collection_identifier)]] = (sample, sample.status)
+
+    # One found → update
+    to_update = [{ **row, "sample_id": matched[row["ordinal"]][0] } for row in rows if row["ordinal"] in matched]
+
+    if to_update:
+        LOG.info(f"Updating {len(to_update):,} existing samples")
+
+        with db.cursor() as cursor:
+            updated = execute_values(cursor, """
+                update warehouse.sample
+                   set identifier = case when input.update_identifiers then input.identifier else sample.identifier end,
+                       collection_identifier = case when input.update_identifiers then input.collection_identifier else sample.collection_identifier end,
+                       collected = coalesce(date_or_null(input.collection_date), sample.collected),
+                       encounter_id = coalesce(input.encounter_id, sample.encounter_id),
+                       details = coalesce(sample.details, '{}'::jsonb) || input.details
+                  from (values %s) as input (sample_id, update_identifiers, identifier, collection_identifier, collection_date, encounter_id, details)
+                 where sample.sample_id = input.sample_id
+                returning sample.sample_id as id, sample.identifier, sample.collection_identifier, sample.encounter_id, 'updated'::text as status
+                """,
+                to_update,
+                template = """(
+                    %(sample_id)s::integer,
+                    %(update_identifiers)s::boolean,
+                    %(identifier)s::text,
+                    %(collection_identifier)s::text,
+                    %(collection_date)s::text,
+                    %(encounter_id)s::integer,
+                    %(additional_details)s::jsonb)""",
+                page_size = len(to_update),
+                fetch = True)
+
+        assert len(updated) == len(to_update), "Update affected fewer rows than expected!"
+
+        ordinals = { row["sample_id"]: row["ordinal"] for row in to_update }
+
+        for sample in updated:
+            results[ordinals[sample.id]] = (sample, sample.status)
+
+    LOG.info(f"Upserted {len(samples):,} samples")
+
+    return [results[ordinal] for ordinal in range(len(samples))]
@@ -68,6 +68,7 @@ setup(
         "flask",
         "fsspec",
         "google-api-python-client <=2.24.0",
+        "ijson >=3.1",
         "jsonschema",
         "more-itertools",
         "oauth2client >2.0.0,<4.0.0",
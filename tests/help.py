@@ -1,3 +1,4 @@
+import click
 import pytest
 from id3c.cli import cli
 from operator import attrgetter
@@ -10,13 +11,11 @@ class Command(NamedTuple):
 def walk_commands(name, command):
     yield Command(" ".join(name), command)
 
-    try:
-        subcommands = command.commands
-    except AttributeError:
-        pass
-    else:
-        for subname, subcommand in subcommands.items():
-            yield from walk_commands([*name, subname], subcommand)
+    if isinstance(command, click.MultiCommand):
+        context = click.Context(command)
+
+        for subname in command.list_commands(context):
+            yield from walk_commands([*name, subname], command.get_command(context, subname))
 
 commands = list(walk_commands(["id3c"], cli))
 